@@ -1,5 +1,7 @@
-import math
 import os
+import inspect
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join as pjoin
 from functools import partial
 import matplotlib.pyplot as plt
@@ -12,12 +14,43 @@ import torch
 from torchvision.utils import make_grid
 import torchvision.transforms.functional as tvtf
 
-from .posterior_mean_variance import get_mean_processor, get_var_processor
+from .nn import timestep_embedding
+from .posterior_mean_variance import get_mean_processor, get_var_processor, extract_and_expand, schedule_dtype, \
+    _as_device_tensor
 
 import osmosis_utils.utils as utilso
 
 __SAMPLER__ = {}
 
+# background worker for the record bookkeeping of p_sample_loop (normalization, color maps, saving the grids)
+_RECORD_POOL = ThreadPoolExecutor(max_workers=1)
+# futures of the process grids still being saved in the background - see wait_for_saved_grids
+_PENDING_GRID_SAVES = []
+
+
+def wait_for_saved_grids():
+    """
+    Wait for the process grids saved in the background by p_sample_loop, and raise the error of a failed save.
+    Called by p_sample_loop for the grids of the previous calls, call it once more after the last sampling.
+    """
+    futures = list(_PENDING_GRID_SAVES)
+    _PENDING_GRID_SAVES.clear()
+    for future in futures:
+        future.result()
+
+
+class SampleOut(namedtuple('SampleOut', ['sample', 'pred_xstart'])):
+    """
+    The output of p_sample. A namedtuple (no dict per step), which can still be indexed by the field name as
+    out['sample'] / out['pred_xstart'].
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return super().__getitem__(key)
+
 
 def register_sampler(name: str):
     def wrapper(cls):
@@ -48,6 +81,9 @@ def create_sampler(sampler,
     sampler = get_sampler(name=sampler)
 
     annealing_time = kwargs.get('annealing_time', False)
+    compile_model = kwargs.get('compile_model', False)
+    use_bf16 = kwargs.get('use_bf16', False)
+    channels_last = kwargs.get('channels_last', False)
     betas = get_named_beta_schedule(noise_schedule, steps)
     if not timestep_respacing:
         timestep_respacing = [steps]
@@ -59,7 +95,10 @@ def create_sampler(sampler,
                    dynamic_threshold=dynamic_threshold,
                    clip_denoised=clip_denoised,
                    rescale_timesteps=rescale_timesteps,
-                   annealing_time=annealing_time)
+                   annealing_time=annealing_time,
+                   compile_model=compile_model,
+                   use_bf16=use_bf16,
+                   channels_last=channels_last)
 
 
 class GaussianDiffusion:
@@ -70,6 +109,9 @@ class GaussianDiffusion:
                  dynamic_threshold,
                  clip_denoised,
                  rescale_timesteps,
+                 compile_model=False,
+                 use_bf16=False,
+                 channels_last=False,
                  **kwargs):
 
         # use float64 for accuracy.
@@ -80,11 +122,18 @@ class GaussianDiffusion:
 
         self.num_timesteps = int(self.betas.shape[0])
         self.rescale_timesteps = rescale_timesteps
+        # rescaled value of every discrete timestep, built once per device - see _scale_timesteps
+        self._t_scale = 1000.0 / self.num_timesteps
+        self._t_lut = None
 
         alphas = 1.0 - self.betas
         self.alphas_cumprod = np.cumprod(alphas, axis=0)
-        self.alphas_cumprod_prev = np.append(1.0, self.alphas_cumprod[:-1])
-        self.alphas_cumprod_next = np.append(self.alphas_cumprod[1:], 0.0)
+        self.alphas_cumprod_prev = np.empty_like(self.alphas_cumprod)
+        self.alphas_cumprod_prev[0] = 1.0
+        self.alphas_cumprod_prev[1:] = self.alphas_cumprod[:-1]
+        self.alphas_cumprod_next = np.empty_like(self.alphas_cumprod)
+        self.alphas_cumprod_next[:-1] = self.alphas_cumprod[1:]
+        self.alphas_cumprod_next[-1] = 0.0
         assert self.alphas_cumprod_prev.shape == (self.num_timesteps,)
 
         # calculations for diffusion q(x_t | x_{t-1}) and others
@@ -100,9 +149,9 @@ class GaussianDiffusion:
         )
         # log calculation clipped because the posterior variance is 0 at the
         # beginning of the diffusion chain.
-        self.posterior_log_variance_clipped = np.log(
-            np.append(self.posterior_variance[1], self.posterior_variance[1:])
-        )
+        self.posterior_log_variance_clipped = self.posterior_variance.copy()
+        self.posterior_log_variance_clipped[0] = self.posterior_variance[1]
+        np.log(self.posterior_log_variance_clipped, out=self.posterior_log_variance_clipped)
         self.posterior_mean_coef1 = (
                 betas * np.sqrt(self.alphas_cumprod_prev) / (1.0 - self.alphas_cumprod)
         )
@@ -112,6 +161,19 @@ class GaussianDiffusion:
                 / (1.0 - self.alphas_cumprod)
         )
 
+        # the cumulative products above stay in float64, the derived coefficients are only used against float32
+        # tensors, so store them in float32 and avoid casting them on every step.
+        for name in ('sqrt_alphas_cumprod',
+                     'sqrt_one_minus_alphas_cumprod',
+                     'log_one_minus_alphas_cumprod',
+                     'sqrt_recip_alphas_cumprod',
+                     'sqrt_recipm1_alphas_cumprod',
+                     'posterior_variance',
+                     'posterior_log_variance_clipped',
+                     'posterior_mean_coef1',
+                     'posterior_mean_coef2'):
+            setattr(self, name, getattr(self, name).astype(np.float32))
+
         self.mean_processor = get_mean_processor(model_mean_type,
                                                  betas=betas,
                                                  dynamic_threshold=dynamic_threshold,
@@ -120,6 +182,111 @@ class GaussianDiffusion:
         self.var_processor = get_var_processor(model_var_type,
                                                betas=betas)
 
+        # torch.compile the model (once per model object) - see _prepare_model
+        self.compile_model = compile_model
+        self._prepared_model = None
+        self._prepared_source = None
+
+        # run the model forward under bfloat16 autocast - see p_mean_variance
+        self.use_bf16 = use_bf16
+        # channels_last memory format for the model and its inputs (faster cudnn convolutions)
+        self.channels_last = channels_last
+
+        # noise buffers reused across the sampling steps, keyed by (shape, dtype, device) - see _noise_like
+        self._noise_bufs = {}
+        # optional torch.Generator (on the sampling device) for the sampling noise, the global generator if None
+        self.generator = None
+
+        # torch copies of the schedules, {(device, dtype): {name: tensor}}, created lazily for the device and the
+        # schedule dtype of the inputs (see _to_device)
+        self._schedule_tensors = {}
+        # dtype of the sampled image and of the schedule arithmetic - see set_compute_dtype
+        self.compute_dtype = torch.float32
+
+    def set_compute_dtype(self, dtype):
+        """
+        Run the sampling loop (the image and the schedule arithmetic) in dtype, float32 or a half precision dtype
+        (torch.bfloat16 / torch.float16). The schedules are kept in float32 on the host, the half precision device
+        copies are rounded from them. With a half precision dtype the model forward always runs under autocast in
+        that dtype (whatever use_bf16 is), the model itself stays in float32.
+        """
+        if dtype not in (torch.float32, torch.float16, torch.bfloat16):
+            raise NotImplementedError(f"unsupported compute dtype: {dtype}")
+        self.compute_dtype = dtype
+        return self
+
+    def _to_device(self, device, dtype=torch.float32):
+        """
+        Cache the schedules used by q_sample / q_mean_variance / q_posterior_mean_variance as torch tensors on
+        the given device (in dtype), so the sampling loop does not copy them from the host on every step.
+        Returns the {name: tensor} dict of the (device, dtype).
+        """
+        schedules = {}
+        for name in ('alphas_cumprod',
+                     'sqrt_alphas_cumprod',
+                     'sqrt_one_minus_alphas_cumprod',
+                     'log_one_minus_alphas_cumprod',
+                     'posterior_mean_coef1',
+                     'posterior_mean_coef2',
+                     'posterior_variance',
+                     'posterior_log_variance_clipped'):
+            schedules[name] = _as_device_tensor(getattr(self, name), device, dtype)
+        self._schedule_tensors[(device, dtype)] = schedules
+        return schedules
+
+    def to(self, device):
+        """
+        Move the schedules of the sampler and of its mean / variance processors to the device ahead of sampling.
+        """
+        # canonical device (e.g. cuda -> cuda:0), the caches are keyed by the device of the sampled tensors
+        device = torch.empty(0, device=device).device
+        if (device, self.compute_dtype) not in self._schedule_tensors:
+            self._to_device(device, self.compute_dtype)
+        self.mean_processor.to(device, self.compute_dtype)
+        self.var_processor.to(device, self.compute_dtype)
+        return self
+
+    def _extract(self, name, t, x):
+        """
+        Index the cached tensor of the schedule `name` by t and reshape it to broadcast against x ([N x 1 x ...]).
+        """
+        # float32 (e.g. the measurement) and half precision (the image) inputs each read their own copies
+        dtype = schedule_dtype(x)
+        schedules = self._schedule_tensors.get((x.device, dtype))
+        if schedules is None:
+            schedules = self._to_device(x.device, dtype)
+        return schedules[name].index_select(0, t).view(-1, *([1] * (x.ndim - 1)))
+
+    def _noise_like(self, x):
+        """
+        Standard normal noise with the shape of x, written into a buffer which is reused across the steps instead
+        of allocating a new tensor each time. The returned tensor is overwritten by the next call with this shape.
+        """
+        key = (x.shape, x.dtype, x.device)
+        noise_buf = self._noise_bufs.get(key)
+        if noise_buf is None:
+            noise_buf = torch.empty(x.shape, dtype=x.dtype, device=x.device)
+            self._noise_bufs[key] = noise_buf
+        return noise_buf.normal_(generator=self.generator)
+
+    def _prepare_model(self, model):
+        """
+        Return the model as it is run by the sampler - channels_last and torch.compile as configured,
+        memoized per model object. Callables which are not a torch module (e.g. _WrappedModel) are returned as is.
+        reduce-overhead compilation uses CUDA graphs, the input shapes are static along the whole sampling loop.
+        """
+        if not isinstance(model, torch.nn.Module):
+            return model
+        if self._prepared_source is not model:
+            prepared_model = model
+            if self.channels_last:
+                prepared_model.to(memory_format=torch.channels_last)
+            if self.compile_model:
+                prepared_model = torch.compile(prepared_model, mode="reduce-overhead", fullgraph=False, dynamic=False)
+            self._prepared_model = prepared_model
+            self._prepared_source = model
+        return self._prepared_model
+
     def q_mean_variance(self, x_start, t):
         """
         Get the distribution q(x_t | x_0).
@@ -129,9 +296,9 @@ class GaussianDiffusion:
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
 
-        mean = extract_and_expand(self.sqrt_alphas_cumprod, t, x_start) * x_start
-        variance = extract_and_expand(1.0 - self.alphas_cumprod, t, x_start)
-        log_variance = extract_and_expand(self.log_one_minus_alphas_cumprod, t, x_start)
+        mean = self._extract('sqrt_alphas_cumprod', t, x_start) * x_start
+        variance = (1.0 - self._extract('alphas_cumprod', t, x_start)).expand_as(x_start)
+        log_variance = self._extract('log_one_minus_alphas_cumprod', t, x_start).expand_as(x_start)
 
         return mean, variance, log_variance
 
@@ -146,13 +313,13 @@ class GaussianDiffusion:
         :param noise: if specified, the split-out normal noise.
         :return: A noisy version of x_start.
         """
-        noise = torch.randn_like(x_start)
+        noise = self._noise_like(x_start)
         assert noise.shape == x_start.shape
 
-        coef1 = extract_and_expand(self.sqrt_alphas_cumprod, t, x_start)
-        coef2 = extract_and_expand(self.sqrt_one_minus_alphas_cumprod, t, x_start)
+        coef1 = self._extract('sqrt_alphas_cumprod', t, x_start)
+        coef2 = self._extract('sqrt_one_minus_alphas_cumprod', t, x_start)
 
-        return coef1 * x_start + coef2 * noise
+        return torch.addcmul(coef1 * x_start, coef2, noise)
 
     def q_posterior_mean_variance(self, x_start, x_t, t):
         """
@@ -162,11 +329,11 @@ class GaussianDiffusion:
 
         """
         assert x_start.shape == x_t.shape
-        coef1 = extract_and_expand(self.posterior_mean_coef1, t, x_start)
-        coef2 = extract_and_expand(self.posterior_mean_coef2, t, x_t)
-        posterior_mean = coef1 * x_start + coef2 * x_t
-        posterior_variance = extract_and_expand(self.posterior_variance, t, x_t)
-        posterior_log_variance_clipped = extract_and_expand(self.posterior_log_variance_clipped, t, x_t)
+        coef1 = self._extract('posterior_mean_coef1', t, x_start)
+        coef2 = self._extract('posterior_mean_coef2', t, x_t)
+        posterior_mean = torch.addcmul(coef1 * x_start, coef2, x_t)
+        posterior_variance = self._extract('posterior_variance', t, x_t).expand_as(x_t)
+        posterior_log_variance_clipped = self._extract('posterior_log_variance_clipped', t, x_t).expand_as(x_t)
 
         assert (
                 posterior_mean.shape[0]
@@ -193,52 +360,80 @@ class GaussianDiffusion:
         The function used for sampling from noise.
         """
 
-        img = x_start
+        # surface the errors of the grid saves of the previous calls
+        wait_for_saved_grids()
+
+        img = x_start.to(self.compute_dtype)
         device = x_start.device
+        self.to(device)
+        if self.channels_last:
+            img = img.contiguous(memory_format=torch.channels_last)
         global_iteration = kwargs.get("global_iteration", False)
         original_file_name = kwargs.get("original_file_name", "image_0")
         save_grids_path = kwargs.get("save_grids_path", None)
+        # the pbar postfix reads values back from the gpu (a synchronization), so it is refreshed every few steps
+        pbar_update_every = kwargs.get("pbar_update_every", 10)
 
         time_val_list = []
         loss_process = []
 
-        if record:
-            rgb_record_list = []
-            depth_record_list = []
+        # the noisy measurement is only sampled for conditioning methods which take it as an argument
+        cond_fn_needs_noisy = 'noisy_measurement' in inspect.signature(measurement_cond_fn).parameters
 
         total_steps = self.num_timesteps
-        pbar = tqdm(list(range(total_steps))[::-1])
+        # the time tensors of all the steps, built once instead of a host to device copy per step
+        time_schedule = torch.arange(total_steps, device=device)
+
+        # the recorded images are written into preallocated [n_images, n_records, 3, h, w] buffers
+        if record:
+            n_images, _, height, width = x_start.shape
+            n_records = len([ii for ii in range(total_steps) if (ii % record_every == 0) or (ii == 0) or (ii == 999)])
+            rgb_record_buf = torch.empty(n_images, n_records, 3, height, width)
+            depth_record_buf = torch.empty(n_images, n_records, 3, height, width)
+            record_idx = 0
+            record_futures = []
+            # the predictions are copied to the host on a side stream, overlapping the next denoising steps
+            record_stream = torch.cuda.Stream(device=device) if device.type == 'cuda' else None
+        pbar = tqdm(range(total_steps - 1, -1, -1), total=total_steps)
 
         # loop over the timestep
         for idx in pbar:
 
-            time = torch.tensor([idx] * img.shape[0], device=device)
-            time_val_list.append(time.cpu().item())
+            time = time_schedule[idx].expand(img.shape[0])
+            # kept on the device, moved to the host once after the loop
+            time_val_list.append(time)
 
-            # flag (bool) for non guidance
+            # flag (bool) for non guidance - compared with the host side idx to avoid a gpu synchronization
             guidance_flag = (sample_pattern['pattern'] == 'original') or \
                             (sample_pattern['pattern'] is None) or \
-                            (sample_pattern['start_guidance'] * self.num_timesteps >= time >= sample_pattern[
+                            (sample_pattern['start_guidance'] * self.num_timesteps >= idx >= sample_pattern[
                                 'stop_guidance'] * self.num_timesteps)
 
             # setting the alternate len (M from the gibbsDDRM paper)
             alternate_len = utilso.set_alternate_length(sample_pattern, idx, self.num_timesteps)
 
+            # measurement and time are fixed along the alternating loop, so it is sampled once per time step
+            noisy_measurement = self.q_sample(measurement, t=time) if cond_fn_needs_noisy else None
+
             # for osmosis use alternate_len=1, means - no alternating
             for alternate_ii in range(alternate_len):
 
-                img.requires_grad = True if guidance_flag else False
-
-                if rgb_guidance:
-                    out = self.p_sample(x=img, t=time, model=model)
-
+                # only the guided steps need the autograd graph of the unet w.r.t the current image
+                if guidance_flag:
+                    img = img.detach().requires_grad_(True)
+                    grad_context = torch.enable_grad()
                 else:
-                    # "clean" the noise with the unet
-                    out = self.p_mean_variance(model=model, x=img, t=time)
-                    out['sample'] = out['mean']
+                    img = img.detach()
+                    grad_context = torch.no_grad()
 
-                # there is no use of the noisy measurement, do we need it? I don't know yet
-                noisy_measurement = self.q_sample(measurement, t=time)
+                with grad_context:
+                    if rgb_guidance:
+                        out = self.p_sample(x=img, t=time, model=model)
+
+                    else:
+                        # "clean" the noise with the unet
+                        out = self.p_mean_variance(model=model, x=img, t=time)
+                        out['sample'] = out['mean']
 
                 # Give condition. -> guiding
                 if pretrain_model == 'osmosis' and not rgb_guidance:
@@ -263,20 +458,24 @@ class GaussianDiffusion:
                         img = out['sample']
 
                     # sampling new img after guidance
-                    noise = torch.randn_like(img, device=img.device)
-                    if time != 0:  # no noise when t == 0
-                        img += torch.exp(0.5 * out['log_variance']) * noise
+                    with torch.no_grad():
+                        noise = self._noise_like(img)
+                        if idx != 0:  # no noise when t == 0
+                            img += torch.exp(0.5 * out['log_variance']) * noise
 
                     # detach result from graph, for the next iteration
-                    img.detach_()
+                    img = img.detach()
 
-                    # update pbar for the last alternating process
+                    # the loss of the last alternating process (loss is a numpy array, no synchronization)
                     if alternate_ii == (alternate_len - 1):
-
                         loss_process.append(loss[0].item())
+
+                    # update pbar for the last alternating process
+                    if alternate_ii == (alternate_len - 1) and idx % pbar_update_every == 0:
+
                         # print and log values
                         pbar_print_dictionary = {}
-                        pbar_print_dictionary['time'] = time.cpu().tolist()
+                        pbar_print_dictionary['time'] = [idx] * img.shape[0]
                         pbar_print_dictionary['loss'] = loss
                         # print auxiliary loss to the pbar
                         if aux_loss is not None:
@@ -302,48 +501,104 @@ class GaussianDiffusion:
                                                     noisy_measurement=noisy_measurement,
                                                     x_prev=img,
                                                     x_0_hat=out['pred_xstart'])
-                    img = img.detach_()
-                    pbar.set_postfix({'loss': loss.detach().cpu().item()}, refresh=False)
+                    img = img.detach()
+                    if idx % pbar_update_every == 0:
+                        pbar.set_postfix({'loss': loss.detach().cpu().item()}, refresh=False)
 
                 # save the images during the diffusion process
                 if record and (alternate_ii == (alternate_len - 1)) and \
                         ((idx % record_every == 0) or (idx == 0) or (idx == 999)):
                     # the RGBD image
-                    mid_x_0_pred_tmp = out['pred_xstart'].detach().cpu()
+                    mid_x_0_pred = out['pred_xstart'].detach()
+
+                    if record_stream is not None:
+                        record_stream.wait_stream(torch.cuda.current_stream(device))
+                        with torch.cuda.stream(record_stream):
+                            # float32 host copy - the record bookkeeping (quantile, numpy) needs float32
+                            mid_x_0_pred_tmp = torch.empty(mid_x_0_pred.shape, dtype=torch.float32,
+                                                           pin_memory=True)
+                            mid_x_0_pred_tmp.copy_(mid_x_0_pred, non_blocking=True)
+                            copy_done = torch.cuda.Event()
+                            copy_done.record(record_stream)
+                        # keep the device memory alive until the side stream copy is done
+                        mid_x_0_pred.record_stream(record_stream)
+                    else:
+                        mid_x_0_pred_tmp = mid_x_0_pred.to(torch.float32, copy=True)
+                        copy_done = None
 
-                    # split into RGB and Depth images
-                    rgb_record_tmp = 0.5 * (mid_x_0_pred_tmp[0, 0:3, :, :] + 1)
-                    rgb_record_tmp_clip = torch.clamp(rgb_record_tmp, 0, 1)
+                    record_futures.append(_RECORD_POOL.submit(self._record_x_0_pred, mid_x_0_pred_tmp, copy_done,
+                                                              rgb_record_buf, depth_record_buf, record_idx))
+                    record_idx += 1
 
-                    # Depth
-                    depth_record_tmp = mid_x_0_pred_tmp[:, 3, :, :]
-                    # percentile + min max norm for the depth image
-                    depth_record_tmp_pmm = utilso.min_max_norm_range_percentile(depth_record_tmp, percent_low=0.05,
-                                                                                percent_high=0.99)
-                    depth_record_tmp_pmm_color = utilso.depth_tensor_to_color_image(depth_record_tmp_pmm)
+        time_val_list = torch.cat(time_val_list).cpu().tolist()
 
-                    rgb_record_list.append(rgb_record_tmp_clip)
-                    depth_record_list.append(depth_record_tmp_pmm_color)
+        # wait for the record bookkeeping (and raise its errors, if any)
+        if record:
+            for future in record_futures:
+                future.result()
 
-        # save the recorded images
+        # save the recorded images in the background, the results are returned without waiting for the png files.
+        # the save is joined (and its errors raised) by wait_for_saved_grids
         if record and (save_grids_path is not None):
-            # save rgb and depth information - images are clipped, depth is percentiled + min-max normalized
-            mid_grid = make_grid(rgb_record_list + depth_record_list, nrow=len(rgb_record_list))
-            mid_grid_pil = tvtf.to_pil_image(mid_grid)
-            mid_grid_pil.save(pjoin(save_grids_path, f'{original_file_name}_process.png'))
+            _PENDING_GRID_SAVES.append(_RECORD_POOL.submit(self._save_process_grids, rgb_record_buf, depth_record_buf,
+                                                           save_grids_path, original_file_name))
 
-        # return the relevant things
+        # return the relevant things, in the dtype of x_start (the sampling may run in a half precision compute_dtype)
+        img = img.to(x_start.dtype)
         if pretrain_model == 'osmosis' and not rgb_guidance:
-            return img, variable_dict, loss, out['pred_xstart'].detach().cpu()
+            return img, variable_dict, loss, out['pred_xstart'].detach().to(x_start.dtype).cpu()
 
         else:
             return img
 
+    @staticmethod
+    def _record_x_0_pred(mid_x_0_pred_tmp, copy_done, rgb_record_buf, depth_record_buf, record_idx):
+        """
+        Split the host copy of the RGBD prediction into the rgb and the (colored) depth record buffers.
+        Runs in the background record thread, copy_done is the cuda event of the host copy (None on cpu).
+        """
+        if copy_done is not None:
+            copy_done.synchronize()
+
+        # split into RGB and Depth images
+        rgb_record_tmp = 0.5 * (mid_x_0_pred_tmp[:, 0:3, :, :] + 1)
+        rgb_record_buf[:, record_idx] = torch.clamp(rgb_record_tmp, 0, 1)
+
+        # Depth - percentile + min max norm for each depth image of the batch
+        depth_record_tmp = mid_x_0_pred_tmp[:, 3:4, :, :]
+        depth_record_tmp_pmm = utilso.min_max_norm_range_percentile(depth_record_tmp, percent_low=0.05,
+                                                                    percent_high=0.99)
+        depth_record_buf[:, record_idx] = utilso.depth_tensor_to_color_image(depth_record_tmp_pmm)
+
+    @staticmethod
+    def _save_process_grids(rgb_record_buf, depth_record_buf, save_grids_path, original_file_name):
+        """
+        Save the recorded process of every image as a grid - rgb records above the depth records.
+        """
+        n_images, n_records = rgb_record_buf.shape[0:2]
+        # save rgb and depth information - images are clipped, depth is percentiled + min-max normalized
+        for ii in range(n_images):
+            mid_grid = make_grid(torch.cat([rgb_record_buf[ii], depth_record_buf[ii]]), nrow=n_records)
+            mid_grid_pil = tvtf.to_pil_image(mid_grid)
+            image_suffix = '' if n_images == 1 else f'_{ii}'
+            mid_grid_pil.save(pjoin(save_grids_path, f'{original_file_name}{image_suffix}_process.png'))
+
     def p_sample(self, model, x, t):
         raise NotImplementedError
 
     def p_mean_variance(self, model, x, t):
-        model_output = model(x, self._scale_timesteps(t))
+        model = self._prepare_model(model)
+        # scale the timesteps outside the (possibly compiled) model call
+        model_t = self._scale_timesteps(t)
+        model_x = x.contiguous(memory_format=torch.channels_last) if self.channels_last else x
+        # only the unet runs under autocast, the schedule math and the guidance gradients stay in compute_dtype.
+        # A half precision x is always run under autocast in its dtype - the unet keeps float32 weights
+        half_x = x.dtype in (torch.float16, torch.bfloat16)
+        autocast_dtype = x.dtype if half_x else torch.bfloat16
+        with torch.autocast(device_type=x.device.type, dtype=autocast_dtype, enabled=self.use_bf16 or half_x):
+            model_output = model(model_x, model_t)
+        if model_output.dtype != x.dtype:
+            model_output = model_output.to(x.dtype)
 
         # In the case of "learned" variance, model will give twice channels.
         if model_output.shape[1] == 2 * x.shape[1]:
@@ -365,9 +620,11 @@ class GaussianDiffusion:
                 'pred_xstart': pred_xstart}
 
     def _scale_timesteps(self, t):
-        if self.rescale_timesteps:
-            return t.float() * (1000.0 / self.num_timesteps)
-        return t
+        if not self.rescale_timesteps:
+            return t
+        if self._t_lut is None or self._t_lut.device != t.device:
+            self._t_lut = torch.arange(self.num_timesteps, device=t.device).float() * self._t_scale
+        return self._t_lut[t]
 
 
 def space_timesteps(num_timesteps, section_counts):
@@ -387,14 +644,17 @@ def space_timesteps(num_timesteps, section_counts):
                            per section. As a special case, use "ddimN" where N
                            is a number of steps to use the striding from the
                            DDIM paper.
-    :return: a set of diffusion steps from the original process to use.
+    :return: a frozenset of diffusion steps from the original process to use.
     """
     if isinstance(section_counts, str):
         if section_counts.startswith("ddim"):
             desired_count = int(section_counts[len("ddim"):])
-            for i in range(1, num_timesteps):
-                if len(range(0, num_timesteps, i)) == desired_count:
-                    return set(range(0, num_timesteps, i))
+            # len(range(0, T, i)) == ceil(T / i) is non-increasing in i, so the smallest stride that can give
+            # desired_count steps is ceil(T / desired_count) - if it does not, no integer stride does.
+            if desired_count > 0:
+                i = -(-num_timesteps // desired_count)
+                if i < num_timesteps and len(range(0, num_timesteps, i)) == desired_count:
+                    return frozenset(range(0, num_timesteps, i))
             raise ValueError(
                 f"cannot create exactly {num_timesteps} steps with an integer stride"
             )
@@ -423,7 +683,7 @@ def space_timesteps(num_timesteps, section_counts):
             cur_idx += frac_stride
         all_steps += taken_steps
         start_idx += size
-    return set(all_steps)
+    return frozenset(all_steps)
 
 
 class SpacedDiffusion(GaussianDiffusion):
@@ -435,21 +695,25 @@ class SpacedDiffusion(GaussianDiffusion):
     """
 
     def __init__(self, use_timesteps, **kwargs):
-        self.use_timesteps = set(use_timesteps)
-        self.timestep_map = []
+        self.use_timesteps = frozenset(use_timesteps)
+        # the retained timesteps in increasing order, for sequential access without iterating a set
+        self.sorted_timesteps = np.asarray(sorted(self.use_timesteps), dtype=np.int64)
+        self.timestep_map = self.sorted_timesteps.tolist()
         self.original_num_steps = len(kwargs["betas"])
 
-        base_diffusion = GaussianDiffusion(**kwargs)  # pylint: disable=missing-kwoa
-        last_alpha_cumprod = 1.0
-        new_betas = []
-        for i, alpha_cumprod in enumerate(base_diffusion.alphas_cumprod):
-            if i in self.use_timesteps:
-                new_betas.append(1 - alpha_cumprod / last_alpha_cumprod)
-                last_alpha_cumprod = alpha_cumprod
-                self.timestep_map.append(i)
-        kwargs["betas"] = np.array(new_betas)
+        # betas of the retained steps, so their cumulative products match the base process at these steps
+        base_alphas_cumprod = np.cumprod(1.0 - np.asarray(kwargs["betas"], dtype=np.float64))
+        alphas_cumprod = base_alphas_cumprod[self.sorted_timesteps]
+        last_alphas_cumprod = np.empty_like(alphas_cumprod)
+        last_alphas_cumprod[0] = 1.0
+        last_alphas_cumprod[1:] = alphas_cumprod[:-1]
+        kwargs["betas"] = 1.0 - alphas_cumprod / last_alphas_cumprod
         super().__init__(**kwargs)
 
+        # the model wrapper of the last wrapped model - see _wrap_model
+        self._wrapped_model = None
+        self._wrapped_source = None
+
     def p_mean_variance(self, model, *args, **kwargs):  # pylint: disable=signature-differs
         return super().p_mean_variance(self._wrap_model(model), *args, **kwargs)
 
@@ -465,9 +729,14 @@ class SpacedDiffusion(GaussianDiffusion):
     def _wrap_model(self, model):
         if isinstance(model, _WrappedModel):
             return model
-        return _WrappedModel(
-            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps
-        )
+        # the wrapper (and its device cache of the timestep map) is reused as long as the model is the same,
+        # it wraps the prepared (compiled) model
+        if self._wrapped_model is None or self._wrapped_source is not model:
+            self._wrapped_model = _WrappedModel(
+                self._prepare_model(model), self.timestep_map, self.rescale_timesteps, self.original_num_steps
+            )
+            self._wrapped_source = model
+        return self._wrapped_model
 
     def _scale_timesteps(self, t):
         # Scaling is done by the wrapped model.
@@ -480,59 +749,208 @@ class _WrappedModel:
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        self._rescale = 1000.0 / original_num_steps
+        # timestep_map as a tensor (already rescaled when rescale_timesteps), per (device, dtype)
+        self._map_cache = {}
+        # sinusoidal embedding of every mapped timestep, per device - only for models taking timestep_emb
+        self._emb_channels = _timestep_emb_channels(model)
+        self._emb_cache = {}
+
+    def _get_map(self, device, dtype_out):
+        key = (device, dtype_out)
+        map_tensor = self._map_cache.get(key)
+        if map_tensor is None:
+            map_tensor = torch.as_tensor(self.timestep_map, device=device)
+            if self.rescale_timesteps:
+                map_tensor = map_tensor.float() * self._rescale
+            else:
+                map_tensor = map_tensor.to(dtype_out)
+            self._map_cache[key] = map_tensor
+        return map_tensor
+
+    def _get_emb_table(self, device):
+        emb_table = self._emb_cache.get(device)
+        if emb_table is None:
+            emb_table = timestep_embedding(self._get_map(device, torch.int64), self._emb_channels)
+            self._emb_cache[device] = emb_table
+        return emb_table
 
     def __call__(self, x, ts, **kwargs):
-        map_tensor = torch.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
-        new_ts = map_tensor[ts]
-        if self.rescale_timesteps:
-            new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
+        if self._emb_channels is not None:
+            # the table is the embedding of the mapped (and rescaled) timesteps, indexed by the local ts directly.
+            # The model does not read the timesteps when timestep_emb is given, so they are not remapped.
+            return self.model(x, ts, timestep_emb=self._get_emb_table(ts.device).index_select(0, ts), **kwargs)
+        new_ts = self._get_map(ts.device, ts.dtype).index_select(0, ts)
         return self.model(x, new_ts, **kwargs)
 
 
+def _timestep_emb_channels(model):
+    """
+    The number of channels of the timestep embedding when the model accepts a precomputed one (timestep_emb), or
+    None. A compiled model is unwrapped to the underlying module.
+    """
+    model = getattr(model, "_orig_mod", model)
+    if not isinstance(model, torch.nn.Module) or not hasattr(model, "model_channels"):
+        return None
+    if "timestep_emb" not in inspect.signature(model.forward).parameters:
+        return None
+    return model.model_channels
+
+
 @register_sampler(name='ddpm')
 class DDPM(SpacedDiffusion):
     def p_sample(self, model, x, t):
         out = self.p_mean_variance(model, x, t)
         sample = out['mean']
 
-        noise = torch.randn_like(x)
-        if t[0] != 0:  # no noise when t == 0
-            sample += torch.exp(0.5 * out['log_variance']) * noise
+        noise = self._noise_like(x)
+        # no noise when t == 0, masked on the device instead of branching on t (which syncs with the host)
+        nonzero_mask = (t != 0).to(x.dtype).view(-1, *([1] * (x.ndim - 1)))
+        sample = torch.addcmul(sample, nonzero_mask, torch.exp(0.5 * out['log_variance']) * noise)
 
-        return {'sample': sample, 'pred_xstart': out['pred_xstart']}
+        return SampleOut(sample, out['pred_xstart'])
 
 
 @register_sampler(name='ddim')
 class DDIM(SpacedDiffusion):
+    def __init__(self, use_timesteps, **kwargs):
+        super().__init__(use_timesteps, **kwargs)
+        # coefficients of the DDIM update per eta - see ddim_coefficients
+        self._ddim_coefficients = {}
+        # the coefficients as a (T, 3) table per (eta, device, dtype) - see ddim_table
+        self._ddim_tables = {}
+        # eps = a * x_t - b * pred_xstart - see predict_eps_from_x_start
+        self._eps_coef_a = (self.sqrt_recip_alphas_cumprod / self.sqrt_recipm1_alphas_cumprod).astype(np.float32)
+        self._eps_coef_b = (1.0 / self.sqrt_recipm1_alphas_cumprod).astype(np.float32)
+
+    def ddim_coefficients(self, eta):
+        """
+        The per timestep coefficients (x_start, eps, sigma) of the DDIM update (Equation 12):
+            sample = c_xstart * pred_xstart + c_eps * eps + c_sigma * noise
+        computed once for every eta in float64.
+        """
+        if eta not in self._ddim_coefficients:
+            alpha_bar = self.alphas_cumprod
+            alpha_bar_prev = self.alphas_cumprod_prev
+            c_sigma = (
+                    eta
+                    * np.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
+                    * np.sqrt(1 - alpha_bar / alpha_bar_prev)
+            )
+            c_xstart = np.sqrt(alpha_bar_prev)
+            c_eps = np.sqrt(1 - alpha_bar_prev - c_sigma ** 2)
+            self._ddim_coefficients[eta] = (c_xstart, c_eps, c_sigma)
+        return self._ddim_coefficients[eta]
+
+    def ddim_table(self, eta, device, dtype=torch.float32):
+        """
+        The coefficients of ddim_coefficients stacked as a (T, 3) tensor on the device, so a step gathers all of
+        them with a single index_select.
+        """
+        key = (eta, device, dtype)
+        table = self._ddim_tables.get(key)
+        if table is None:
+            table = torch.from_numpy(np.stack(self.ddim_coefficients(eta), axis=1).astype(np.float32))
+            table = table.to(device=device, dtype=dtype)
+            self._ddim_tables[key] = table
+        return table
+
     def p_sample(self, model, x, t, eta=0.0):
         out = self.p_mean_variance(model, x, t)
 
         eps = self.predict_eps_from_x_start(x, t, out['pred_xstart'])
 
-        alpha_bar = extract_and_expand(self.alphas_cumprod, t, x)
-        alpha_bar_prev = extract_and_expand(self.alphas_cumprod_prev, t, x)
-        sigma = (
-                eta
-                * torch.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
-                * torch.sqrt(1 - alpha_bar / alpha_bar_prev)
-        )
-        # Equation 12.
-        noise = torch.randn_like(x)
-        mean_pred = (
-                out["pred_xstart"] * torch.sqrt(alpha_bar_prev)
-                + torch.sqrt(1 - alpha_bar_prev - sigma ** 2) * eps
-        )
+        # [N x 3 x 1 x ...] -> three [N x 1 x ...] coefficients
+        ddim_table = self.ddim_table(eta, x.device, schedule_dtype(x))
+        coefs = ddim_table.index_select(0, t).view(t.shape[0], 3, *([1] * (x.ndim - 1)))
+        c_xstart, c_eps, c_sigma = coefs.unbind(1)
 
-        sample = mean_pred
-        if t != 0:
-            sample += sigma * noise
+        # Equation 12.
+        sample = torch.addcmul(out["pred_xstart"] * c_xstart, c_eps, eps)
+        # sigma is zero for eta == 0 (deterministic DDIM), otherwise no noise when t == 0 - masked on the device
+        if eta != 0.0:
+            noise = self._noise_like(x)
+            nonzero_mask = (t != 0).to(x.dtype).view(-1, *([1] * (x.ndim - 1)))
+            sample.addcmul_(c_sigma * nonzero_mask, noise)
 
-        return {"sample": sample, "pred_xstart": out["pred_xstart"]}
+        return SampleOut(sample, out["pred_xstart"])
 
     def predict_eps_from_x_start(self, x_t, t, pred_xstart):
-        coef1 = extract_and_expand(self.sqrt_recip_alphas_cumprod, t, x_t)
-        coef2 = extract_and_expand(self.sqrt_recipm1_alphas_cumprod, t, x_t)
-        return (coef1 * x_t - pred_xstart) / coef2
+        coef_a = extract_and_expand(self._eps_coef_a, t, x_t)
+        coef_b = extract_and_expand(self._eps_coef_b, t, x_t)
+        return torch.addcmul(x_t * coef_a, pred_xstart, coef_b, value=-1)
+
+
+class GraphedSampler:
+    """
+    Gradient free sampling with the whole sampling step captured into a CUDA graph.
+
+    The step (model forward and p_sample update, which has no host synchronization) is run for a few warmup steps
+    on a side stream and then captured once with static input and output buffers. Every step copies x and t into
+    the static inputs and replays the graph, which removes the launch overhead of all the step kernels.
+    There is no autograd through the graph, so this is only for sampling without guidance. The step noise is drawn
+    from the default cuda generator (sampler.generator must be None).
+
+    :param sampler: a registered sampler (ddpm, ddim).
+    :param model: the unet, on a cuda device.
+    :param warmup_steps: number of eager model calls before the capture.
+    """
+
+    def __init__(self, sampler, model, warmup_steps=3):
+        self.sampler = sampler
+        self.model = model
+        self.graphed_step = _GraphedStep(self._step, warmup_steps)
+
+    def _step(self, x, t):
+        return self.sampler.p_sample(model=self.model, x=x, t=t).sample
+
+    @torch.no_grad()
+    def p_sample_loop(self, x_start):
+        img = x_start
+        total_steps = self.sampler.num_timesteps
+        # all the time values are prefilled, each step only indexes the table
+        time_schedule = torch.arange(total_steps, device=img.device)
+
+        for idx in tqdm(range(total_steps - 1, -1, -1), total=total_steps):
+            time = time_schedule[idx].expand(img.shape[0])
+            img = self.graphed_step(img, time)
+
+        # the output buffer of the graph is overwritten by the next replay
+        return img.clone()
+
+
+class _GraphedStep:
+    def __init__(self, step_fn, warmup_steps):
+        self.step_fn = step_fn
+        self.warmup_steps = warmup_steps
+        self.graph = None
+
+    def __call__(self, x, ts):
+        # the graph is bound to the shapes of the static buffers, capture again if they change
+        if self.graph is None or x.shape != self.static_x.shape or ts.shape != self.static_ts.shape:
+            self._capture(x, ts)
+        self.static_x.copy_(x)
+        self.static_ts.copy_(ts)
+        self.graph.replay()
+        # static_out is overwritten by the next replay
+        return self.static_out
+
+    def _capture(self, x, ts):
+        self.static_x = x.detach().clone()
+        self.static_ts = ts.detach().clone()
+
+        # warmup on a side stream, so the lazy initializations (cudnn, allocator, the device copies of the
+        # schedules, the noise buffer) are not captured
+        side_stream = torch.cuda.Stream(device=x.device)
+        side_stream.wait_stream(torch.cuda.current_stream(x.device))
+        with torch.cuda.stream(side_stream):
+            for _ in range(self.warmup_steps):
+                self.step_fn(self.static_x, self.static_ts)
+        torch.cuda.current_stream(x.device).wait_stream(side_stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_out = self.step_fn(self.static_x, self.static_ts)
 
 
 # =================
@@ -560,7 +978,7 @@ def get_named_beta_schedule(schedule_name, num_diffusion_timesteps):
     elif schedule_name == "cosine":
         return betas_for_alpha_bar(
             num_diffusion_timesteps,
-            lambda t: math.cos((t + 0.008) / 1.008 * math.pi / 2) ** 2,
+            lambda t: np.cos((t + 0.008) / 1.008 * np.pi / 2) ** 2,
         )
     else:
         raise NotImplementedError(f"unknown beta schedule: {schedule_name}")
@@ -578,6 +996,16 @@ def betas_for_alpha_bar(num_diffusion_timesteps, alpha_bar, max_beta=0.999):
     :param max_beta: the maximum beta to use; use values lower than 1 to
                      prevent singularities.
     """
+    # alpha_bar written with numpy ufuncs (np.cos, ...) is evaluated on all the time points at once, functions of
+    # python scalars only (math.cos, ...) fall back to the loop below
+    t = np.arange(num_diffusion_timesteps + 1, dtype=np.float64) / num_diffusion_timesteps
+    try:
+        alpha_bars = np.asarray(alpha_bar(t), dtype=np.float64)
+    except (TypeError, ValueError):
+        alpha_bars = None
+    if alpha_bars is not None and alpha_bars.shape == t.shape:
+        return np.minimum(1 - alpha_bars[1:] / alpha_bars[:-1], max_beta)
+
     betas = []
     for i in range(num_diffusion_timesteps):
         t1 = i / num_diffusion_timesteps
@@ -590,23 +1018,18 @@ def betas_for_alpha_bar(num_diffusion_timesteps, alpha_bar, max_beta=0.999):
 # Helper function
 # ================
 
-def extract_and_expand(array, time, target):
-    array = torch.from_numpy(array).to(target.device)[time].float()
-    while array.ndim < target.ndim:
-        array = array.unsqueeze(-1)
-    return array.expand_as(target)
-
-
 def expand_as(array, target):
+    if isinstance(array, (float, np.floating)):
+        # a 0-D tensor broadcasts against target as is
+        return torch.tensor(float(array), device=target.device, dtype=target.dtype)
     if isinstance(array, np.ndarray):
-        array = torch.from_numpy(array)
-    elif isinstance(array, np.float):
-        array = torch.tensor([array])
+        array = torch.from_numpy(array).to(target.device, non_blocking=True)
+    else:
+        array = array.to(target.device, non_blocking=True)
 
-    while array.ndim < target.ndim:
-        array = array.unsqueeze(-1)
+    array = array.view(*array.shape, *([1] * (target.ndim - array.ndim)))
 
-    return array.expand_as(target).to(target.device)
+    return array.expand_as(target)
 
 
 def _extract_into_tensor(arr, timesteps, broadcast_shape):
@@ -619,7 +1042,6 @@ def _extract_into_tensor(arr, timesteps, broadcast_shape):
                             dimension equal to the length of timesteps.
     :return: a tensor of shape [batch_size, 1, ...] where the shape has K dims.
     """
-    res = torch.from_numpy(arr).to(device=timesteps.device)[timesteps].float()
-    while len(res.shape) < len(broadcast_shape):
-        res = res[..., None]
+    res = _as_device_tensor(arr, timesteps.device).index_select(0, timesteps)
+    res = res.view(*res.shape, *([1] * (len(broadcast_shape) - res.ndim)))
     return res.expand(broadcast_shape)
@@ -3,6 +3,7 @@ Various utilities for neural networks.
 """
 
 import math
+from contextlib import ExitStack
 
 import torch as th
 import torch.nn as nn
@@ -139,12 +140,28 @@ def checkpoint(func, inputs, params, flag):
         return func(*inputs)
 
 
+def _autocast_state():
+    """
+    The autocast state of the cuda and the cpu devices, as {device_type: (enabled, dtype)}, and the cache flag.
+    """
+    if hasattr(th, "get_autocast_dtype"):
+        # PyTorch >= 2.4, the per device getters replace the gpu / cpu specific ones
+        devices = {device_type: (th.is_autocast_enabled(device_type), th.get_autocast_dtype(device_type))
+                   for device_type in ("cuda", "cpu")}
+    else:
+        devices = {"cuda": (th.is_autocast_enabled(), th.get_autocast_gpu_dtype()),
+                   "cpu": (th.is_autocast_cpu_enabled(), th.get_autocast_cpu_dtype())}
+    return devices, th.is_autocast_cache_enabled()
+
+
 class CheckpointFunction(th.autograd.Function):
     @staticmethod
     def forward(ctx, run_function, length, *args):
         ctx.run_function = run_function
         ctx.input_tensors = list(args[:length])
         ctx.input_params = list(args[length:])
+        # the backward pass recomputes the forward, under the same autocast state (as torch.utils.checkpoint)
+        ctx.autocast_state = _autocast_state()
         with th.no_grad():
             output_tensors = ctx.run_function(*ctx.input_tensors)
         return output_tensors
@@ -152,7 +169,13 @@ class CheckpointFunction(th.autograd.Function):
     @staticmethod
     def backward(ctx, *output_grads):
         ctx.input_tensors = [x.detach().requires_grad_(True) for x in ctx.input_tensors]
-        with th.enable_grad():
+        autocast_devices, autocast_cache = ctx.autocast_state
+        with th.enable_grad(), ExitStack() as autocast_stack:
+            for device_type, (enabled, dtype) in autocast_devices.items():
+                if enabled:
+                    autocast_stack.enter_context(
+                        th.autocast(device_type=device_type, dtype=dtype, cache_enabled=autocast_cache)
+                    )
             # Fixes a bug where the first op in run_function modifies the
             # Tensor storage in place, which is not allowed for detach()'d
             # Tensors.
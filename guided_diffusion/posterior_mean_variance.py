@@ -1,3 +1,4 @@
+import weakref
 from abc import ABC, abstractmethod
 
 import numpy as np
@@ -40,6 +41,11 @@ class MeanProcessor(ABC):
     def get_mean_and_xstart(self, x, t, model_output):
         pass
 
+    def to(self, device, dtype=torch.float32):
+        """Copy the schedule arrays of the processor to the device (in dtype) ahead of the sampling loop."""
+        _cache_on_device(self, device, dtype)
+        return self
+
     def process_xstart(self, x):
         if self.dynamic_threshold:
             x = dynamic_thresholding(x, s=0.98)
@@ -56,15 +62,18 @@ class PreviousXMeanProcessor(MeanProcessor):
         super().__init__(betas, dynamic_threshold, clip_denoised)
         alphas = 1.0 - betas
         alphas_cumprod = np.cumprod(alphas, axis=0)
-        alphas_cumprod_prev = np.append(1.0, alphas_cumprod[:-1])
+        alphas_cumprod_prev = np.concatenate(([1.0], alphas_cumprod[:-1]))
 
         self.posterior_mean_coef1 = betas * np.sqrt(alphas_cumprod_prev) / (1.0 - alphas_cumprod)
         self.posterior_mean_coef2 = (1.0 - alphas_cumprod_prev) * np.sqrt(alphas) / (1.0 - alphas_cumprod)
+        self.recip_posterior_mean_coef1 = 1.0 / self.posterior_mean_coef1
+        self.posterior_mean_coef2_ratio = self.posterior_mean_coef2 / self.posterior_mean_coef1
+        _store_float32(self)
 
     def predict_xstart(self, x_t, t, x_prev):
-        coef1 = extract_and_expand(1.0 / self.posterior_mean_coef1, t, x_t)
-        coef2 = extract_and_expand(self.posterior_mean_coef2 / self.posterior_mean_coef1, t, x_t)
-        return coef1 * x_prev - coef2 * x_t
+        coef1 = extract_and_expand(self.recip_posterior_mean_coef1, t, x_t)
+        coef2 = extract_and_expand(self.posterior_mean_coef2_ratio, t, x_t)
+        return torch.addcmul(coef1 * x_prev, coef2, x_t, value=-1)
 
     def get_mean_and_xstart(self, x, t, model_output):
         mean = model_output
@@ -78,10 +87,11 @@ class StartXMeanProcessor(MeanProcessor):
         super().__init__(betas, dynamic_threshold, clip_denoised)
         alphas = 1.0 - betas
         alphas_cumprod = np.cumprod(alphas, axis=0)
-        alphas_cumprod_prev = np.append(1.0, alphas_cumprod[:-1])
+        alphas_cumprod_prev = np.concatenate(([1.0], alphas_cumprod[:-1]))
 
         self.posterior_mean_coef1 = betas * np.sqrt(alphas_cumprod_prev) / (1.0 - alphas_cumprod)
         self.posterior_mean_coef2 = (1.0 - alphas_cumprod_prev) * np.sqrt(alphas) / (1.0 - alphas_cumprod)
+        _store_float32(self)
 
     def q_posterior_mean(self, x_start, x_t, t):
         """
@@ -92,7 +102,7 @@ class StartXMeanProcessor(MeanProcessor):
         coef1 = extract_and_expand(self.posterior_mean_coef1, t, x_start)
         coef2 = extract_and_expand(self.posterior_mean_coef2, t, x_t)
 
-        return coef1 * x_start + coef2 * x_t
+        return torch.addcmul(coef1 * x_start, coef2, x_t)
 
     def get_mean_and_xstart(self, x, t, model_output):
         pred_xstart = self.process_xstart(model_output)
@@ -107,12 +117,13 @@ class EpsilonXMeanProcessor(MeanProcessor):
         super().__init__(betas, dynamic_threshold, clip_denoised)
         alphas = 1.0 - betas
         alphas_cumprod = np.cumprod(alphas, axis=0)
-        alphas_cumprod_prev = np.append(1.0, alphas_cumprod[:-1])
+        alphas_cumprod_prev = np.concatenate(([1.0], alphas_cumprod[:-1]))
 
         self.sqrt_recip_alphas_cumprod = np.sqrt(1.0 / alphas_cumprod)
         self.sqrt_recipm1_alphas_cumprod = np.sqrt(1.0 / alphas_cumprod - 1)
         self.posterior_mean_coef1 = betas * np.sqrt(alphas_cumprod_prev) / (1.0 - alphas_cumprod)
         self.posterior_mean_coef2 = (1.0 - alphas_cumprod_prev) * np.sqrt(alphas) / (1.0 - alphas_cumprod)
+        _store_float32(self)
 
     def q_posterior_mean(self, x_start, x_t, t):
         """
@@ -122,12 +133,12 @@ class EpsilonXMeanProcessor(MeanProcessor):
         assert x_start.shape == x_t.shape
         coef1 = extract_and_expand(self.posterior_mean_coef1, t, x_start)
         coef2 = extract_and_expand(self.posterior_mean_coef2, t, x_t)
-        return coef1 * x_start + coef2 * x_t
+        return torch.addcmul(coef1 * x_start, coef2, x_t)
 
     def predict_xstart(self, x_t, t, eps):
         coef1 = extract_and_expand(self.sqrt_recip_alphas_cumprod, t, x_t)
         coef2 = extract_and_expand(self.sqrt_recipm1_alphas_cumprod, t, eps)
-        return coef1 * x_t - coef2 * eps
+        return torch.addcmul(coef1 * x_t, coef2, eps, value=-1)
 
     def get_mean_and_xstart(self, x, t, model_output):
         pred_xstart = self.process_xstart(self.predict_xstart(x, t, model_output))
@@ -168,24 +179,32 @@ class VarianceProcessor(ABC):
     def get_variance(self, x, t):
         pass
 
+    def to(self, device, dtype=torch.float32):
+        """Copy the schedule arrays of the processor to the device (in dtype) ahead of the sampling loop."""
+        _cache_on_device(self, device, dtype)
+        return self
+
 
 @register_var_processor(name='fixed_small')
 class FixedSmallVarianceProcessor(VarianceProcessor):
     def __init__(self, betas):
         alphas = 1.0 - betas
         alphas_cumprod = np.cumprod(alphas, axis=0)
-        alphas_cumprod_prev = np.append(1.0, alphas_cumprod[:-1])
+        alphas_cumprod_prev = np.concatenate(([1.0], alphas_cumprod[:-1]))
         # calculations for posterior q(x_{t-1} | x_t, x_0)
         self.posterior_variance = (
                 betas * (1.0 - alphas_cumprod_prev) / (1.0 - alphas_cumprod)
         )
+        self.posterior_log_variance = np.log(self.posterior_variance)
+        _store_float32(self)
 
     def get_variance(self, x, t):
         model_variance = self.posterior_variance
-        model_log_variance = np.log(model_variance)
+        model_log_variance = self.posterior_log_variance
 
-        model_variance = extract_and_expand(model_variance, t, x)
-        model_log_variance = extract_and_expand(model_log_variance, t, x)
+        # the [N x 1 x ...] coefficients are expanded, the variances have the full shape of x
+        model_variance = extract_and_expand(model_variance, t, x).expand_as(x)
+        model_log_variance = extract_and_expand(model_log_variance, t, x).expand_as(x)
 
         return model_variance, model_log_variance
 
@@ -197,18 +216,23 @@ class FixedLargeVarianceProcessor(VarianceProcessor):
 
         alphas = 1.0 - betas
         alphas_cumprod = np.cumprod(alphas, axis=0)
-        alphas_cumprod_prev = np.append(1.0, alphas_cumprod[:-1])
+        alphas_cumprod_prev = np.concatenate(([1.0], alphas_cumprod[:-1]))
         # calculations for posterior q(x_{t-1} | x_t, x_0)
         self.posterior_variance = (
                 betas * (1.0 - alphas_cumprod_prev) / (1.0 - alphas_cumprod)
         )
+        # the variance is the (clipped) betas
+        self.model_variance = np.concatenate(([self.posterior_variance[1]], betas[1:]))
+        self.model_log_variance = np.log(self.model_variance)
+        _store_float32(self)
 
     def get_variance(self, x, t):
-        model_variance = np.append(self.posterior_variance[1], self.betas[1:])
-        model_log_variance = np.log(model_variance)
+        model_variance = self.model_variance
+        model_log_variance = self.model_log_variance
 
-        model_variance = extract_and_expand(model_variance, t, x)
-        model_log_variance = extract_and_expand(model_log_variance, t, x)
+        # the [N x 1 x ...] coefficients are expanded, the variances have the full shape of x
+        model_variance = extract_and_expand(model_variance, t, x).expand_as(x)
+        model_log_variance = extract_and_expand(model_log_variance, t, x).expand_as(x)
 
         return model_variance, model_log_variance
 
@@ -231,7 +255,7 @@ class LearnedRangeVarianceProcessor(VarianceProcessor):
 
         alphas = 1.0 - betas
         alphas_cumprod = np.cumprod(alphas, axis=0)
-        alphas_cumprod_prev = np.append(1.0, alphas_cumprod[:-1])
+        alphas_cumprod_prev = np.concatenate(([1.0], alphas_cumprod[:-1]))
 
         # calculations for posterior q(x_{t-1} | x_t, x_0)
         posterior_variance = (
@@ -240,13 +264,15 @@ class LearnedRangeVarianceProcessor(VarianceProcessor):
         # log calculation clipped because the posterior variance is 0 at the
         # beginning of the diffusion chain.
         self.posterior_log_variance_clipped = np.log(
-            np.append(posterior_variance[1], posterior_variance[1:])
+            np.concatenate(([posterior_variance[1]], posterior_variance[1:]))
         )
+        self.log_betas = np.log(betas)
+        _store_float32(self)
 
     def get_variance(self, x, t):
         model_var_values = x
         min_log = self.posterior_log_variance_clipped
-        max_log = np.log(self.betas)
+        max_log = self.log_betas
 
         min_log = extract_and_expand(min_log, t, x)
         max_log = extract_and_expand(max_log, t, x)
@@ -262,20 +288,68 @@ class LearnedRangeVarianceProcessor(VarianceProcessor):
 # Helper function
 # ================
 
+# device copies of the schedule arrays, {id(array): {(device, dtype): tensor}}. The entries of an array are
+# evicted when the array is freed (weakref.finalize), so its id cannot be reused while cached and the copies of
+# the schedules of a discarded sampler do not outlive it.
+_DEVICE_CACHE = {}
+# half precision targets read half precision copies of the schedules, any other target reads float32 copies
+_HALF_DTYPES = (torch.float16, torch.bfloat16)
+
+
+def _store_float32(processor):
+    # the schedules are computed in float64, but only ever used against float32 tensors
+    for name, value in list(vars(processor).items()):
+        if isinstance(value, np.ndarray):
+            setattr(processor, name, value.astype(np.float32))
+
+
+def _cache_on_device(processor, device, dtype=torch.float32):
+    for value in vars(processor).values():
+        if isinstance(value, np.ndarray):
+            _as_device_tensor(value, device, dtype)
+
+
+def _as_device_tensor(array, device, dtype=torch.float32):
+    """
+    The cached device copy of a numpy array, the same tensor object on every call while the array is alive.
+    """
+    array_cache = _DEVICE_CACHE.get(id(array))
+    if array_cache is None:
+        array_cache = _DEVICE_CACHE[id(array)] = {}
+        weakref.finalize(array, _DEVICE_CACHE.pop, id(array), None)
+    tensor = array_cache.get((device, dtype))
+    if tensor is None:
+        # always a copy (also on the cpu), a tensor sharing the memory of the array would keep it alive.
+        # the half precision copies are rounded from the float32 (or float64) host array
+        tensor = torch.from_numpy(array).to(device=device, dtype=dtype, non_blocking=True, copy=True)
+        array_cache[(device, dtype)] = tensor
+    return tensor
+
+
+def schedule_dtype(target):
+    """The dtype of the schedule coefficients used against the target tensor."""
+    return target.dtype if target.dtype in _HALF_DTYPES else torch.float32
+
+
 def extract_and_expand(array, time, target):
-    array = torch.from_numpy(array).to(target.device)[time].float()
-    while array.ndim < target.ndim:
-        array = array.unsqueeze(-1)
-    return array.expand_as(target)
+    dtype = schedule_dtype(target)
+    if isinstance(array, np.ndarray):
+        array = _as_device_tensor(array, target.device, dtype)
+    else:
+        array = array.to(device=target.device, dtype=dtype)
+    # [N x 1 x ...] - broadcasts against target in the elementwise arithmetic of the callers
+    return array.index_select(0, time).view(-1, *([1] * (target.ndim - 1)))
 
 
 def expand_as(array, target):
+    if isinstance(array, (float, np.floating)):
+        # a 0-D tensor broadcasts against target as is
+        return torch.tensor(float(array), device=target.device, dtype=target.dtype)
     if isinstance(array, np.ndarray):
-        array = torch.from_numpy(array)
-    elif isinstance(array, np.float):
-        array = torch.tensor([array])
+        array = torch.from_numpy(array).to(target.device, non_blocking=True)
+    else:
+        array = array.to(target.device, non_blocking=True)
 
-    while array.ndim < target.ndim:
-        array = array.unsqueeze(-1)
+    array = array.view(*array.shape, *([1] * (target.ndim - array.ndim)))
 
-    return array.expand_as(target).to(target.device)
+    return array.expand_as(target)
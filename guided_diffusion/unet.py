@@ -710,13 +710,14 @@ class UNetModel(nn.Module):
         self.middle_block.apply(convert_module_to_f32)
         self.output_blocks.apply(convert_module_to_f32)
 
-    def forward(self, x, timesteps, y=None):
+    def forward(self, x, timesteps, y=None, timestep_emb=None):
         """
         Apply the model to an input batch.
 
         :param x: an [N x C x ...] Tensor of inputs.
         :param timesteps: a 1-D batch of timesteps.
         :param y: an [N] Tensor of labels, if class-conditional.
+        :param timestep_emb: an optional precomputed [N x model_channels] sinusoidal embedding of the timesteps.
         :return: an [N x C x ...] Tensor of outputs.
         """
         assert (y is not None) == (
@@ -724,7 +725,9 @@ class UNetModel(nn.Module):
         ), "must specify y if and only if the model is class-conditional"
 
         hs = []
-        emb = self.time_embed(timestep_embedding(timesteps, self.model_channels))
+        if timestep_emb is None:
+            timestep_emb = timestep_embedding(timesteps, self.model_channels)
+        emb = self.time_embed(timestep_emb)
 
         if self.num_classes is not None:
             assert y.shape == (x.shape[0],)
@@ -18,7 +18,7 @@ from torchvision.utils import make_grid
 from guided_diffusion.condition_methods import get_conditioning_method
 from guided_diffusion.measurements import get_noise, get_operator
 from guided_diffusion.unet import create_model
-from guided_diffusion.gaussian_diffusion import create_sampler
+from guided_diffusion.gaussian_diffusion import create_sampler, wait_for_saved_grids
 from osmosis_utils import logger
 
 import osmosis_utils.utils as utilso
@@ -405,6 +405,9 @@ def main() -> None:
 
                 logger.log(f"Run time: {datetime.datetime.now() - start_run_time_ii}")
 
+    # wait for the process grids which are still saved in the background
+    wait_for_saved_grids()
+
     # close the logger txt file
     logger.get_current().close()
 
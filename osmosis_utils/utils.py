@@ -45,30 +45,20 @@ def min_max_norm(img, global_norm=True, is_uint8=True):
 
 def min_max_norm_range(img, vmin=0, vmax=1, is_uint8=False):
     """
-    assume input is a torch tensor [3/1,h,w] or [Batch,3/1,h,w]
+    assume input is a torch tensor [3/1,h,w] or [Batch,3/1,h,w], a batch is normalized per image
     """
 
     vmin = float(vmin)
     vmax = float(vmax)
 
-    # Compute the minimum and maximum values for each image in the batch separately
-    if len(img.shape) == 4:
-        # support a batch
-        img_min = img.view(img.size(0), -1).min(dim=1, keepdim=True)[0].view(-1, 1, 1, 1)
-        img_max = img.view(img.size(0), -1).max(dim=1, keepdim=True)[0].view(-1, 1, 1, 1)
-
-    elif len(img.shape) == 3:
-        img_max = img.max()
-        img_min = img.min()
-
-    else:
+    if len(img.shape) not in (3, 4):
         raise NotImplementedError
 
-    if img_min == img_max:
-        img_norm = torch.zeros_like(img)
-    else:
-        scale = (vmax - vmin) / (img_max - img_min)
-        img_norm = (img - img_min) * scale + vmin
+    # the minimum and maximum values of each image in the batch (of the whole tensor for a single image)
+    img_min = img.amin(dim=(-3, -2, -1), keepdim=True)
+    img_max = img.amax(dim=(-3, -2, -1), keepdim=True)
+
+    img_norm = _min_max_scale(img, img_min, img_max, vmin, vmax)
 
     if is_uint8:
         img_norm = (255 * img_norm).to(torch.uint8)
@@ -78,35 +68,33 @@ def min_max_norm_range(img, vmin=0, vmax=1, is_uint8=False):
 
 def min_max_norm_range_percentile(img, vmin=0, vmax=1, percent_low=0., percent_high=1., is_uint8=False):
     """
-    assume input is a torch tensor [3/1,h,w]
+    assume input is a torch tensor [3/1,h,w] or [Batch,3/1,h,w], a batch is normalized per image
     """
 
+    if len(img.shape) == 4:
+        # percentile values of each image in the batch
+        percent = torch.tensor([percent_low, percent_high], dtype=img.dtype, device=img.device)
+        img_percentile = torch.quantile(img.flatten(1), q=percent, dim=1).view(2, -1, 1, 1, 1)
+        img_min, img_max = img_percentile[0], img_percentile[1]
+
+    elif len(img.shape) == 3:
+        img_min = torch.quantile(img, q=percent_low)
+        img_max = torch.quantile(img, q=percent_high)
+
+    else:
+        raise NotImplementedError
+
     # first clip into percentile values
-    img_min = torch.quantile(img, q=percent_low)
-    img_max = torch.quantile(img, q=percent_high)
     img_clip = torch.clamp(img, img_min, img_max)
 
     vmin = float(vmin)
     vmax = float(vmax)
 
     # Compute the minimum and maximum values for each image in the batch separately
-    if len(img_clip.shape) == 4:
-        # support a batch
-        img_min = img_clip.view(img.size(0), -1).min(dim=1, keepdim=True)[0].view(-1, 1, 1, 1)
-        img_max = img_clip.view(img.size(0), -1).max(dim=1, keepdim=True)[0].view(-1, 1, 1, 1)
-
-    elif len(img.shape) == 3:
-        img_max = img_clip.max()
-        img_min = img_clip.min()
-
-    else:
-        raise NotImplementedError
+    img_min = img_clip.amin(dim=(-3, -2, -1), keepdim=True)
+    img_max = img_clip.amax(dim=(-3, -2, -1), keepdim=True)
 
-    if img_min == img_max:
-        img_norm = torch.zeros_like(img_clip)
-    else:
-        scale = (vmax - vmin) / (img_max - img_min)
-        img_norm = (img_clip - img_min) * scale + vmin
+    img_norm = _min_max_scale(img_clip, img_min, img_max, vmin, vmax)
 
     if is_uint8:
         img_norm = (255 * img_norm).to(torch.uint8)
@@ -114,6 +102,17 @@ def min_max_norm_range_percentile(img, vmin=0, vmax=1, percent_low=0., percent_h
     return img_norm
 
 
+def _min_max_scale(img, img_min, img_max, vmin, vmax):
+    """
+    scale img from [img_min, img_max] into [vmin, vmax], constant images are set to zeros
+    """
+    img_range = img_max - img_min
+    is_constant = img_range == 0
+    scale = (vmax - vmin) / torch.where(is_constant, torch.ones_like(img_range), img_range)
+
+    return torch.where(is_constant, torch.zeros_like(img), (img - img_min) * scale + vmin)
+
+
 def max_norm(img, global_norm=True, is_uint8=True):
     """
     assume input is a torch tensor [3,h,w]
@@ -746,8 +745,18 @@ def color_histogram(img, title=None):
 # %% save depth tensor into rgb with colormap (instead of grayscale)
 
 def depth_tensor_to_color_image(tensor_image, colormap='viridis'):
+    """
+    :param tensor_image: depth tensor [h,w], [1,h,w] or [1,1,h,w], or a batch of depth images [Batch,1,h,w]
+    :return: colored tensor image [3,h,w], or [Batch,3,h,w] for a batch
+    """
     cm = plt.get_cmap(colormap)
 
+    # a batch of depth images - color all of them with a single colormap call
+    if len(tensor_image.shape) == 4 and tensor_image.shape[0] > 1:
+        assert tensor_image.shape[1] == 1
+        im_np = cm(tensor_image[:, 0].numpy())
+        return torch.tensor(im_np[..., 0:3]).permute(0, 3, 1, 2)
+
     if len(tensor_image.shape) == 4:
         tensor_image = tensor_image.squeeze()
 